@@ -1,84 +1,158 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
+import pyarrow as pa
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+from threading import Lock
+from uuid import uuid4
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Uploaded files are cached by upload id and size; the default hash also covers the read position,
+# which moves every time a file is parsed.
+UPLOADED_FILE_HASH_FUNCS = {
+    "streamlit.runtime.uploaded_file_manager.UploadedFile": lambda file: (file.file_id, file.size)
+}
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path("cache")
+CACHE_DIR_MAX_BYTES = 500 * 1024 ** 2
+CACHE_TMP_MAX_AGE_SECONDS = 3600  # Older temporary files cannot belong to a write still in progress
+CACHE_FORMAT_VERSION = 1  # Bump whenever parse_contact_file or parse_netatmo_file change their output
+
+def find_sessions(states, dates):
+    """Return the opening and closing row of every closed session plus the number of sessions started.
+
+    The first run resets after 30 hours and restarts, the second resets on its last reading so its close
+    is ignored, and the last run never closes:
+
+    >>> hours = np.array([0, 30, 31, 32, 40, 50, 70, 71, 80, 81, 90])
+    >>> dates = np.datetime64("2024-01-01T00") + hours * np.timedelta64(1, "h")
+    >>> open_pos, close_pos, open_sessions = find_sessions(np.array([1, 1, 1, 0, 1, 1, 1, 0, 1, 0, 1]), dates)
+    >>> open_pos.tolist(), close_pos.tolist(), open_sessions
+    ([2, 8], [3, 9], 5)
+    """
+    # Every run of consecutive Open readings starts a session at its first reading
+    is_open = states == 1
+    run_first = np.flatnonzero(is_open & ~np.r_[False, is_open[:-1]])
+    run_last = np.flatnonzero(is_open & ~np.r_[is_open[1:], False])
+    open_pos = run_first.copy()  # Opening the following close is measured from, -1 after a reset
+    open_sessions = len(run_first)
+
+    # A reading more than 24 hours after the opening resets the session (potential measurement error)
+    # and the reading after it starts a new one. Such runs are rare, so they are walked one by one.
+    max_gap = np.timedelta64(24, "h")
+    for k in np.flatnonzero(dates[run_last] - dates[run_first] > max_gap):
+        start, last = run_first[k], run_last[k]
+        while start != -1 and dates[last] - dates[start] > max_gap:
+            reset = start + np.searchsorted(dates[start:last + 1], dates[start] + max_gap, side="right")
+            start = reset + 1 if reset < last else -1
+            if start != -1:
+                open_sessions += 1
+        open_pos[k] = start
+
+    close_pos = run_last + 1
+    has_close = (open_pos != -1) & (close_pos < len(states))
+    open_pos, close_pos = open_pos[has_close], close_pos[has_close]
+    return open_pos, close_pos, open_sessions
 
 def calculate_statistics(df, start_date, end_date, accessory_name):
-    if start_date is None or end_date is None:
+    df = filter_data_by_time(df, start_date, end_date)
+    if (start_date is None or end_date is None) and not df.empty:
         start_date, end_date = df["Date"].min(), df["Date"].max()
 
-    df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)].copy()
-    df["Date_Only"] = df["Date"].dt.date  # Extract date for grouping
-
-    open_sessions = 0
-    session_durations = []
-    daily_open_times = {}
-    open_time = None
-
-    for i, row in df.iterrows():
-        if row["State"] == 1:  # Contact Open
-            if open_time is not None:
-                time_gap = (row["Date"] - open_time).total_seconds() / 3600  # Convert to hours
-                if time_gap > 24:
-                    open_time = None  # Reset due to potential measurement error
-                    continue
-            if open_time is None:
-                open_time = row["Date"]
-                open_sessions += 1
-        elif row["State"] == 0 and open_time is not None:  # Contact Closed
-            duration = (row["Date"] - open_time).total_seconds() / 60
-            if duration <= 1440:  # Ensure duration is realistic (less than 24 hours)
-                session_durations.append(duration)
-                day = row["Date_Only"]
-                if day not in daily_open_times:
-                    daily_open_times[day] = 0
-                daily_open_times[day] += duration
-            open_time = None
-
-    df_daily = pd.DataFrame(list(daily_open_times.items()), columns=["Date_Only", "Open_Duration"])
-    df_daily["Closed_Duration"] = 1440 - df_daily["Open_Duration"]
-
-    mean_open_sessions = open_sessions / df_daily.shape[0] if df_daily.shape[0] > 0 else 0
-    mean_open_minutes = df_daily["Open_Duration"].mean()
-    mean_closed_minutes = df_daily["Closed_Duration"].mean()
-    mean_open_time_per_session = sum(session_durations) / len(session_durations) if session_durations else 0
+    mean_open_minutes = mean_closed_minutes = np.nan
+    mean_open_sessions = mean_open_time_per_session = 0
+
+    if len(df) > 1:  # A session needs at least an opening and a closing reading
+        dates = df["Date"].to_numpy()
+        open_pos, close_pos, open_sessions = find_sessions(df["State"].to_numpy(), dates)
+
+        durations = (dates[close_pos] - dates[open_pos]) / np.timedelta64(1, "m")
+        realistic = durations <= 1440  # Ensure duration is realistic (less than 24 hours)
+        session_durations = durations[realistic]
+        session_days = dates[close_pos][realistic].astype("datetime64[D]")  # Floor to the day for grouping
+
+        sessions = pd.DataFrame({"Date_Only": session_days, "Open_Duration": session_durations})
+        df_daily = sessions.groupby("Date_Only", sort=False)["Open_Duration"].sum().reset_index()
+        df_daily["Closed_Duration"] = 1440 - df_daily["Open_Duration"]
+
+        mean_open_sessions = open_sessions / df_daily.shape[0] if df_daily.shape[0] > 0 else 0
+        mean_open_minutes = df_daily["Open_Duration"].mean()
+        mean_closed_minutes = df_daily["Closed_Duration"].mean()
+        mean_open_time_per_session = session_durations.mean() if len(session_durations) else 0
 
     return {
         "Accessory Name": accessory_name,
-        "From": start_date.strftime("%Y-%m-%d %H:%M:%S"),
-        "To": end_date.strftime("%Y-%m-%d %H:%M:%S"),
-        "Number of Days": (end_date - start_date).days + 1,
+        "From": start_date.strftime("%Y-%m-%d %H:%M:%S") if start_date is not None else "-",
+        "To": end_date.strftime("%Y-%m-%d %H:%M:%S") if end_date is not None else "-",
+        "Number of Days": (end_date - start_date).days + 1 if start_date is not None else 0,
         "Mean Minutes Open Per Day": mean_open_minutes,
         "Mean Minutes Closed Per Day": mean_closed_minutes,
         "Mean Opening Sessions Per Day": mean_open_sessions,
         "Mean Open Time Per Session": mean_open_time_per_session
     }
 
-def plot_contact_data(files, combined_plot, start_date, end_date, show_stats):
-    all_stats = []
+def overall_statistics(all_stats):
+    # Mean of each statistic over all files, skipping NaN like DataFrame.mean() does
+    overall_stats = {}
+    for key in ["Mean Minutes Open Per Day", "Mean Minutes Closed Per Day", "Mean Opening Sessions Per Day",
+                "Mean Open Time Per Session"]:
+        values = [stats[key] for stats in all_stats if not np.isnan(stats[key])]
+        overall_stats[key] = sum(values) / len(values) if values else np.nan
+    return overall_stats
+
+@st.cache_resource(show_spinner=False, max_entries=24)
+def contact_figure(file_ids, window, title, _frames):
+    # Cached per uploads and figure_window(); _frames is derived from those and skipped by the cache key
+    fig = Figure(figsize=(12, 5))  # Built outside pyplot, whose global figure manager is not thread-safe
+    ax = fig.subplots()
+    for df, accessory_name in _frames:
+        ax.step(*step_points(df), where="post", label=accessory_name, linewidth=2)
+    ax.set_xlabel("Date/Time")
+    ax.set_ylabel("Contact State (1 = Open, 0 = Closed)")
+    ax.set_title(f"Contact Open/Closed State Over Time - {title}")
+    ax.set_yticks([0, 1], labels=["Closed", "Open"])
+    ax.tick_params(axis="x", labelrotation=45)
+    ax.grid(True, linestyle="--", alpha=0.6)
+    ax.legend()
+    return fig
+
+def figure_window(time_filter, start_date, end_date):
+    # Relative filters end at now(), so their bounds are coarsened to the minute to let reruns reuse figures
+    if start_date is None or end_date is None:
+        return time_filter, None, None
+    return time_filter, start_date.replace(second=0, microsecond=0), end_date.replace(second=0, microsecond=0)
 
-    if combined_plot:
-        plt.figure(figsize=(12, 5))
+@st.cache_resource
+def figure_lock():
+    # main.py is re-executed on every rerun, so the lock is cached to be shared by the whole process
+    return Lock()
+
+def show_figure(fig):
+    # Cached figures are shared between sessions and Agg rendering is not thread-safe
+    with figure_lock():
+        st.pyplot(fig)
 
-    for file in files:
-        df, accessory_name = read_contact_file(file)
+def plot_contact_data(files, combined_plot, time_filter, start_date, end_date, show_stats):
+    all_stats = []
+    frames = []
+    window = figure_window(time_filter, start_date, end_date)
 
-        if start_date is not None and end_date is not None:
-            df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
+    for file, (df, accessory_name) in zip(files, read_files(files, read_contact_file)):
+        df = filter_data_by_time(df, start_date, end_date)
+        frames.append((df, accessory_name))
 
-        if combined_plot:
-            plt.step(df["Date"], df["State"], where="post", label=accessory_name, linewidth=2)
-        else:
-            plt.figure(figsize=(12, 5))
-            plt.step(df["Date"], df["State"], where="post", label=accessory_name, linewidth=2)
-            plt.xlabel("Date/Time")
-            plt.ylabel("Contact State (1 = Open, 0 = Closed)")
-            plt.title(f"Contact Open/Closed State Over Time - {accessory_name}")
-            plt.yticks([0, 1], labels=["Closed", "Open"])
-            plt.xticks(rotation=45)
-            plt.grid(True, linestyle="--", alpha=0.6)
-            plt.legend()
-            st.pyplot(plt)
+        if not combined_plot:
+            show_figure(contact_figure((file.file_id,), window, accessory_name, [(df, accessory_name)]))
 
         if show_stats:
             stats = calculate_statistics(df, start_date, end_date, accessory_name)
@@ -87,40 +161,104 @@ def plot_contact_data(files, combined_plot, start_date, end_date, show_stats):
             st.write(stats)
 
     if combined_plot:
-        plt.xlabel("Date/Time")
-        plt.ylabel("Contact State (1 = Open, 0 = Closed)")
-        plt.title("Contact Open/Closed State Over Time - Combined")
-        plt.yticks([0, 1], labels=["Closed", "Open"])
-        plt.xticks(rotation=45)
-        plt.grid(True, linestyle="--", alpha=0.6)
-        plt.legend()
-        st.pyplot(plt)
+        file_ids = tuple(file.file_id for file in files)
+        show_figure(contact_figure(file_ids, window, "Combined", frames))
 
     if len(all_stats) > 1:
-        overall_stats = pd.DataFrame(all_stats).drop(
-            columns=["Accessory Name", "From", "To", "Number of Days"]).mean().to_dict()
+        overall_stats = overall_statistics(all_stats)
         st.write("### Overall Statistics (Mean Over All Uploaded Files)")
         st.write(overall_stats)
 
-def read_contact_file(file):
-    metadata_df = pd.read_excel(file, sheet_name="Contact", nrows=3, header=None)  # Read first 3 metadata lines
+def parse_contact_file(file):
+    with pd.ExcelFile(file, engine="calamine") as xl:  # Open the workbook once for both reads
+        metadata_df = xl.parse("Contact", nrows=3, header=None)  # Read first 3 metadata lines
+        df = xl.parse("Contact", skiprows=3)  # Skip metadata rows
     accessory_name = metadata_df.iloc[0, 0].split(": ")[1] if len(metadata_df.columns) > 1 else "Unknown"
 
-    df = pd.read_excel(file, sheet_name="Contact", skiprows=3)  # Skip metadata rows
-    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%dT%H:%M:%S")
-    df = df.sort_values("Date")
-    df["State"] = df["Contact"].map({"Open": 1, "Closed": 0})
+    df["Date"] = pd.to_datetime(df["Date"], format="ISO8601", cache=True)
+    if not df["Date"].is_monotonic_increasing:  # Exports are usually chronological already
+        df = df.sort_values("Date")
+    df = df[df["Contact"].isin(["Open", "Closed"])].copy()  # Blank or unknown readings carry no state
+    df["State"] = (df["Contact"].to_numpy() == "Open").astype(np.int8)  # 1 = Open, 0 = Closed
+    df = df.drop(columns="Contact")  # State carries the same information in one byte per row
     return df, accessory_name
 
-def read_netatmo_file(file):
-    metadata_df = pd.read_excel(file, sheet_name="Worksheet", nrows=2, header=None)
+def parse_netatmo_file(file):
+    with pd.ExcelFile(file, engine="calamine") as xl:
+        metadata_df = xl.parse("Worksheet", nrows=2, header=None)
+        df = xl.parse("Worksheet", skiprows=2)
     accessory_name = metadata_df.iloc[1, 3].split(" ")[1]
 
-    df = pd.read_excel(file, sheet_name="Worksheet", skiprows=2)
-    df["Date"] = pd.to_datetime(df["Timezone : Europe/Berlin"], format="%Y/%m/%d %H:%M:%S")
-    df = df.sort_values("Date")
+    df["Date"] = pd.to_datetime(df["Timezone : Europe/Berlin"], format="%Y/%m/%d %H:%M:%S", cache=True)
+    if not df["Date"].is_monotonic_increasing:  # Exports are usually chronological already
+        df = df.sort_values("Date")
+    return df, accessory_name
+
+def read_through_disk_cache(file, parse):
+    # Parsed frames are stored by content hash, so files uploaded before skip the xlsx parse even after a restart
+    digest = hashlib.blake2b(file.getvalue(), digest_size=16).hexdigest()
+    path = CACHE_DIR / f"{parse.__name__}-v{CACHE_FORMAT_VERSION}-{digest}.parquet"
+    try:
+        os.utime(path)  # Modification time is the last use for eviction; unlike touch() this never creates the file
+        df = pd.read_parquet(path)
+        return df, df.attrs["Accessory Name"]
+    except (OSError, KeyError, pa.ArrowException):
+        # Missing, evicted while being read, unreadable or not writable: treat it as a miss like the write path
+        with suppress(OSError):
+            path.unlink(missing_ok=True)
+
+    df, accessory_name = parse(file)
+    df.attrs["Accessory Name"] = accessory_name
+    tmp_path = path.with_suffix(f".{uuid4().hex}.tmp")  # Write aside so readers never see a partial file
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        df.to_parquet(tmp_path, compression="zstd")
+        tmp_path.replace(path)
+    except (OSError, ValueError, pa.ArrowException):
+        # The cache is only an optimisation: mixed-type columns, non-string headers or an unwritable
+        # directory leave the parsed frame uncached
+        tmp_path.unlink(missing_ok=True)
+        logger.warning("Could not cache %s on disk", file.name, exc_info=True)
+        return df, accessory_name
+    evict_disk_cache()
     return df, accessory_name
 
+def evict_disk_cache():
+    # Drop the least recently used frames once the cache grows past its size limit, and temporary files
+    # left behind by writes that never finished (e.g. a killed process)
+    entries = []
+    for path in CACHE_DIR.iterdir():
+        try:
+            stat = path.stat()
+            if path.suffix == ".parquet":
+                entries.append((stat, path))
+            elif path.suffix == ".tmp" and time.time() - stat.st_mtime > CACHE_TMP_MAX_AGE_SECONDS:
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue  # Already removed by another session or worker
+
+    total_size = 0
+    for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime, reverse=True):
+        total_size += stat.st_size
+        if total_size > CACHE_DIR_MAX_BYTES:
+            path.unlink(missing_ok=True)
+
+@st.cache_data(show_spinner=False, max_entries=12, hash_funcs=UPLOADED_FILE_HASH_FUNCS)
+def read_contact_file(file):
+    return read_through_disk_cache(file, parse_contact_file)
+
+@st.cache_data(show_spinner=False, max_entries=12, hash_funcs=UPLOADED_FILE_HASH_FUNCS)
+def read_netatmo_file(file):
+    return read_through_disk_cache(file, parse_netatmo_file)
+
+def read_file(file):
+    return read_contact_file(file) if "Contact" in file.name else read_netatmo_file(file)
+
+def read_files(files, reader=read_file):
+    # Parse the uploads in parallel, the workers share the script context for st.cache_data
+    with ThreadPoolExecutor(max_workers=6, initializer=partial(add_script_run_ctx, ctx=get_script_run_ctx())) as ex:
+        return list(ex.map(reader, files))
+
 
 def add_fake_states(df, start_date, end_date):
     if start_date is None:
@@ -132,8 +270,8 @@ def add_fake_states(df, start_date, end_date):
     if df.empty:
         return df
 
-    first_state = df.iloc[0]["State"]
-    last_state = df.iloc[-1]["State"]
+    first_state = df["State"].iat[0]
+    last_state = df["State"].iat[-1]
 
     fake_start = pd.DataFrame([{"Date": start, "State": last_state}])
     fake_end = pd.DataFrame([{"Date": end, "State": last_state}])
@@ -141,29 +279,58 @@ def add_fake_states(df, start_date, end_date):
     df = pd.concat([fake_start, df, fake_end], ignore_index=True)
     return df
 
+def step_points(df, column="State"):
+    # Repeated values draw nothing new in a step plot, keep only the changes plus both end points
+    values = df[column].to_numpy()
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:-1] = values[1:-1] != values[:-2]
+    return df["Date"].to_numpy()[keep], values[keep]
+
 def filter_data_by_time(df, start_date, end_date):
     if start_date is None or end_date is None:
         return df  # Return unfiltered if no time range is set
-    return df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
-
+    # Frames are sorted by Date, so the range is a contiguous slice found by binary search
+    start = df["Date"].searchsorted(start_date, side="left")
+    end = df["Date"].searchsorted(end_date, side="right")
+    return df.iloc[start:end]
 
-def plot_multiple_data(files, selected_measurements, start_date, end_date, show_stats):
-    all_stats = []
 
-    fig, ax1 = plt.subplots(figsize=(12, 5))
+@st.cache_resource(show_spinner=False, max_entries=12)
+def sensor_figure(file_ids, measurements, window, _frames):
+    # Cached like contact_figure, _frames holds the (file, measurement, df, name) of each plotted series
+    fig = Figure(figsize=(12, 5))
+    ax1 = fig.subplots()
     ax2 = ax1.twinx()
 
-    for file, measurement in selected_measurements:
-        df, name = (read_contact_file(file) if "Contact" in file.name else read_netatmo_file(file))
+    for file, measurement, df, name in _frames:
+        if "Contact" in file.name:
+            ax2.step(*step_points(df, measurement), where="post", label=f"{name} - {measurement}", linewidth=2,
+                     linestyle='--')
+        else:
+            ax1.plot(df["Date"], df[measurement], label=f"{name} - {measurement}", linewidth=2, color="purple")
+
+    ax1.set_xlabel("Date/Time")
+    ax1.set_ylabel("Netatmo Values")
+    ax2.set_ylabel("Contact Sensor State (0/1)")
+
+    ax1.legend(loc="upper left")
+    ax2.legend(loc="upper right")
+
+    ax2.set_title("Combined Sensor Data")
+    ax2.grid(True, linestyle="--", alpha=0.6)
+    return fig
+
+def plot_multiple_data(files, selected_measurements, time_filter, start_date, end_date, show_stats):
+    all_stats = []
+    plotted = []
+
+    frames = read_files([file for file, _ in selected_measurements])
+    for (file, measurement), (df, name) in zip(selected_measurements, frames):
         df = filter_data_by_time(df, start_date, end_date)
         df = add_fake_states(df, start_date, end_date) if "Contact" in file.name else df
 
         if measurement in df.columns:
-            if "Contact" in file.name:
-                ax2.step(df["Date"], df[measurement], where="post", label=f"{name} - {measurement}", linewidth=2,
-                         linestyle='--')
-            else:
-                ax1.plot(df["Date"], df[measurement], label=f"{name} - {measurement}", linewidth=2, color="purple")
+            plotted.append((file, measurement, df, name))
 
         if "Contact" in file.name and show_stats:
             stats = calculate_statistics(df, start_date, end_date, name)
@@ -171,20 +338,13 @@ def plot_multiple_data(files, selected_measurements, start_date, end_date, show_
             st.write(f"### Statistics for {name}")
             st.write(stats)
 
-    ax1.set_xlabel("Date/Time")
-    ax1.set_ylabel("Netatmo Values")
-    ax2.set_ylabel("Contact Sensor State (0/1)")
-
-    ax1.legend(loc="upper left")
-    ax2.legend(loc="upper right")
-
-    plt.title("Combined Sensor Data")
-    plt.grid(True, linestyle="--", alpha=0.6)
-    st.pyplot(fig)
+    file_ids = tuple(file.file_id for file, _ in selected_measurements)
+    measurements = tuple(measurement for _, measurement in selected_measurements)
+    window = figure_window(time_filter, start_date, end_date)
+    show_figure(sensor_figure(file_ids, measurements, window, plotted))
 
     if len(all_stats) > 1:
-        overall_stats = pd.DataFrame(all_stats).drop(
-            columns=["Accessory Name", "From", "To", "Number of Days"]).mean().to_dict()
+        overall_stats = overall_statistics(all_stats)
         st.write("### Overall Statistics (Mean Over All Uploaded Files)")
         st.write(overall_stats)
 
@@ -236,8 +396,7 @@ def main():
     if netatmo_and_eve:
         selected_measurements = []
         if uploaded_files:
-            for file in uploaded_files:
-                df, name = (read_contact_file(file) if "Contact" in file.name else read_netatmo_file(file))
+            for file, (df, name) in zip(uploaded_files, read_files(uploaded_files)):
                 if "Contact" in file.name:
                     measurement = "State"
                 else:
@@ -245,13 +404,13 @@ def main():
                 selected_measurements.append((file, measurement))
 
         if uploaded_files:
-            plot_multiple_data(uploaded_files, selected_measurements, start_date, end_date, show_stats)
+            plot_multiple_data(uploaded_files, selected_measurements, time_filter, start_date, end_date, show_stats)
     else:
         if uploaded_files:
             if len(uploaded_files) > 6:
                 st.error("Please upload a maximum of 6 files.")
             else:
-                plot_contact_data(uploaded_files, combined_plot, start_date, end_date, show_stats)
+                plot_contact_data(uploaded_files, combined_plot, time_filter, start_date, end_date, show_stats)
 
 if __name__ == "__main__":
     main()